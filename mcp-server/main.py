@@ -1,9 +1,11 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any, Union
-import os, json, time
+import os, json, time, re, math, threading, heapq, itertools, asyncio
+from collections import deque
 from dotenv import load_dotenv
 from openai import OpenAI
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -16,6 +18,33 @@ api_key = os.getenv("OPENAI_API_KEY")
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173").split(",")
 API_KEYS = os.getenv("API_KEYS", "").split(",") if os.getenv("API_KEYS") else []
 
+# Limites da conta OpenAI usados pelo scheduler de chamadas upstream
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "8"))
+OPENAI_BACKGROUND_MAX_IN_FLIGHT = int(os.getenv("OPENAI_BACKGROUND_MAX_IN_FLIGHT", "2"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+# Limites da fila: chamadas além disso são recusadas em vez de esperar para sempre
+SCHEDULER_MAX_QUEUE_DEPTH = int(os.getenv("SCHEDULER_MAX_QUEUE_DEPTH", "100"))
+SCHEDULER_MAX_QUEUE_WAIT = float(os.getenv("SCHEDULER_MAX_QUEUE_WAIT", "30"))
+
+# Pesos por API key no fair queuing (ex: "chave1:2,chave2:1"); padrão 1
+def parse_key_weights(raw: str) -> Dict[str, float]:
+    weights = {}
+    for position, item in enumerate(raw.split(","), 1):
+        if not item.strip():
+            continue
+        key, _, weight = item.strip().partition(":")
+        try:
+            value = float(weight)
+        except ValueError:
+            value = 0.0
+        if not key or value <= 0:
+            print(f"⚠️ SCHEDULER_KEY_WEIGHTS: entrada {position} ignorada (use chave:peso com peso > 0)")
+            continue
+        weights[key] = value
+    return weights
+
+SCHEDULER_KEY_WEIGHTS = parse_key_weights(os.getenv("SCHEDULER_KEY_WEIGHTS", ""))
+
 print(f"🔑 OPENAI_API_KEY carregada: {'✅' if api_key else '❌'}")
 print(f"🔑 Chave (primeiros 3 chars): {api_key[:3] if api_key else 'NENHUMA'}...")
 print(f"🛡️ API Keys configuradas: {len(API_KEYS)} chaves")
@@ -23,6 +52,192 @@ print(f"🌐 Origins permitidas: {ALLOWED_ORIGINS}")
 
 client = OpenAI(api_key=api_key)
 
+# Classes de prioridade: interativo (UI/ChatGPT) sempre antes de background
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = [PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND]
+
+# Tokens de saída estimados por chamada, antes de saber o uso real
+ESTIMATED_COMPLETION_TOKENS = 800
+
+class SchedulerBusy(Exception):
+    """Chamada recusada pelo scheduler (fila cheia, espera esgotada ou cliente saiu)"""
+
+class UpstreamScheduler:
+    """Scheduler central para todas as chamadas chat.completions.
+
+    - Prioridade estrita entre classes: background só usa a capacidade que sobra
+      e nunca passa de background_max_in_flight, deixando vagas para interativo.
+    - Dentro de cada classe, weighted fair queuing por API key (tags de
+      término virtual), para uma chave não monopolizar a fila.
+    - Limite global de chamadas simultâneas e ritmo de tokens por minuto.
+
+    A espera na fila acontece no event loop (asyncio), sem ocupar threads do
+    threadpool; só a chamada à OpenAI em si roda numa thread.
+    """
+
+    def __init__(self, max_in_flight: int, background_max_in_flight: int,
+                 tokens_per_minute: int, key_weights: Dict[str, float],
+                 max_queue_depth: int, max_queue_wait: float):
+        self.max_in_flight = max_in_flight
+        self.background_max_in_flight = background_max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.key_weights = key_weights
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait
+        self._cond = asyncio.Condition()
+        self._seq = itertools.count()
+        self._queues = {p: [] for p in PRIORITIES}  # heap de (término, seq, ticket)
+        self._virtual_time = {p: 0.0 for p in PRIORITIES}
+        self._last_finish = {p: {} for p in PRIORITIES}
+        self._in_flight = {p: 0 for p in PRIORITIES}
+        self._token_window = deque()  # [timestamp, tokens] do último minuto
+        self._waits = {p: deque(maxlen=500) for p in PRIORITIES}
+        self._rejected = {p: 0 for p in PRIORITIES}
+
+    def _tokens_last_minute(self, now: float) -> int:
+        while self._token_window and now - self._token_window[0][0] >= 60:
+            self._token_window.popleft()
+        return sum(tokens for _, tokens in self._token_window)
+
+    def _can_start(self, priority: str, entry: tuple, now: float) -> bool:
+        if self._queues[priority][0] is not entry:
+            return False
+        for higher in PRIORITIES[:PRIORITIES.index(priority)]:
+            if self._queues[higher]:
+                return False
+        if sum(self._in_flight.values()) >= self.max_in_flight:
+            return False
+        if priority == PRIORITY_BACKGROUND and self._in_flight[priority] >= self.background_max_in_flight:
+            return False
+        used = self._tokens_last_minute(now)
+        # Uma chamada maior que o limite passa sozinha, senão nunca sairia da fila
+        return used == 0 or used + entry[2]["tokens"] <= self.tokens_per_minute
+
+    def _wait_timeout(self, now: float) -> float:
+        if self._token_window:
+            return max(0.05, 60 - (now - self._token_window[0][0]))
+        return 1.0
+
+    def _reset_if_idle(self, priority: str):
+        if not self._queues[priority]:
+            # Fila vazia: todos os fluxos ociosos, reinicia o relógio virtual
+            self._virtual_time[priority] = 0.0
+            self._last_finish[priority].clear()
+
+    async def _wait_turn(self, priority: str, entry: tuple, is_disconnected) -> None:
+        deadline = time.monotonic() + self.max_queue_wait
+        waited = False
+        while not self._can_start(priority, entry, time.monotonic()):
+            waited = True
+            now = time.monotonic()
+            if now >= deadline:
+                raise SchedulerBusy(f"Tempo máximo na fila esgotado ({self.max_queue_wait:g}s)")
+            if is_disconnected is not None and await is_disconnected():
+                raise SchedulerBusy("Cliente desconectou enquanto aguardava na fila")
+            # Acorda ao menos a cada 1s para checar prazo e desconexão
+            timeout = min(deadline - now, self._wait_timeout(now), 1.0)
+            try:
+                await asyncio.wait_for(self._cond.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        # Chegou a vez: não gasta uma chamada se o cliente já foi embora
+        if waited and is_disconnected is not None and await is_disconnected():
+            raise SchedulerBusy("Cliente desconectou enquanto aguardava na fila")
+
+    async def submit(self, fn, priority: str, client_key: str, estimated_tokens: int,
+                     is_disconnected=None):
+        """Espera a vez na fila e executa fn() (a chamada à OpenAI) numa thread"""
+        enqueued = time.monotonic()
+        async with self._cond:
+            if len(self._queues[priority]) >= self.max_queue_depth:
+                self._rejected[priority] += 1
+                raise SchedulerBusy(f"Fila {priority} cheia ({self.max_queue_depth})")
+
+            weight = self.key_weights.get(client_key, 1.0)
+            start = max(self._virtual_time[priority], self._last_finish[priority].get(client_key, 0.0))
+            finish = start + estimated_tokens / weight
+            self._last_finish[priority][client_key] = finish
+            ticket = {"tokens": estimated_tokens, "start": start}
+            entry = (finish, next(self._seq), ticket)
+            heapq.heappush(self._queues[priority], entry)
+
+            try:
+                await self._wait_turn(priority, entry, is_disconnected)
+            except BaseException as e:
+                # Sai da fila sem chamar a OpenAI (timeout, desconexão ou cancelamento)
+                self._queues[priority].remove(entry)
+                heapq.heapify(self._queues[priority])
+                self._reset_if_idle(priority)
+                if isinstance(e, SchedulerBusy):
+                    self._rejected[priority] += 1
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._queues[priority])
+            self._virtual_time[priority] = max(self._virtual_time[priority], start)
+            self._reset_if_idle(priority)
+            self._in_flight[priority] += 1
+            reservation = [time.monotonic(), estimated_tokens]
+            self._token_window.append(reservation)
+            self._waits[priority].append(reservation[0] - enqueued)
+            self._cond.notify_all()
+
+        try:
+            resp = await run_in_threadpool(fn)
+            usage = getattr(resp, "usage", None)
+            if usage is not None:
+                reservation[1] = usage.total_tokens
+            return resp
+        finally:
+            async with self._cond:
+                self._in_flight[priority] -= 1
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        # Descarta entradas expiradas da janela de tokens: só pode ser chamado
+        # no event loop (health_check é async), como _can_start e submit
+        classes = {}
+        for p in PRIORITIES:
+            waits = sorted(self._waits[p])
+            classes[p] = {
+                "queue_depth": len(self._queues[p]),
+                "in_flight": self._in_flight[p],
+                "rejected": self._rejected[p],
+                "wait_avg_ms": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                "wait_p95_ms": round(1000 * waits[int(0.95 * (len(waits) - 1))], 1) if waits else 0.0,
+                "wait_max_ms": round(1000 * waits[-1], 1) if waits else 0.0,
+            }
+        return {
+            "classes": classes,
+            "tokens_last_minute": self._tokens_last_minute(time.monotonic()),
+            "limits": {
+                "max_in_flight": self.max_in_flight,
+                "background_max_in_flight": self.background_max_in_flight,
+                "tokens_per_minute": self.tokens_per_minute,
+                "max_queue_depth": self.max_queue_depth,
+                "max_queue_wait_s": self.max_queue_wait,
+            },
+        }
+
+scheduler = UpstreamScheduler(
+    max_in_flight=OPENAI_MAX_IN_FLIGHT,
+    background_max_in_flight=OPENAI_BACKGROUND_MAX_IN_FLIGHT,
+    tokens_per_minute=OPENAI_TPM_LIMIT,
+    key_weights=SCHEDULER_KEY_WEIGHTS,
+    max_queue_depth=SCHEDULER_MAX_QUEUE_DEPTH,
+    max_queue_wait=SCHEDULER_MAX_QUEUE_WAIT,
+)
+
+async def chat_completion(priority: str, client_key: str, is_disconnected=None, **kwargs):
+    """Todas as chamadas chat.completions passam por aqui (via scheduler)"""
+    prompt_chars = sum(len(m.get("content") or "") for m in kwargs.get("messages", []))
+    estimated_tokens = prompt_chars // 4 + ESTIMATED_COMPLETION_TOKENS
+    return await scheduler.submit(
+        lambda: client.chat.completions.create(**kwargs),
+        priority, client_key, estimated_tokens, is_disconnected
+    )
+
 # Função para verificar API key
 def verify_api_key(request: Request) -> bool:
     if not API_KEYS:  # Se não tiver API keys configuradas, permite acesso
@@ -35,6 +250,13 @@ def verify_api_key(request: Request) -> bool:
     token = auth_header.replace("Bearer ", "")
     return token in API_KEYS
 
+# Chave usada no fair queuing: a API key do cliente ou, sem ela, o IP
+# (só aceita o token se ele for uma das API_KEYS configuradas)
+def client_key(request: Request) -> str:
+    if API_KEYS and verify_api_key(request):
+        return request.headers["Authorization"].replace("Bearer ", "")
+    return get_remote_address(request)
+
 # Rate limiter setup
 limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(title="NutriAI MCP Server")
@@ -101,9 +323,211 @@ Retorne SEMPRE JSON válido com:
 - Nada de texto fora do JSON.
 """
 
+DEFAULT_DISCLAIMER = "Estimativa educativa; não substitui orientação médica."
+
+# Contadores do estágio de reparo (expostos em /health)
+REPAIR_STATS = {"ok": 0, "repaired": 0, "rerequested": 0, "failed": 0}
+_repair_lock = threading.Lock()
+
+def _count_repair(kind: str):
+    with _repair_lock:
+        REPAIR_STATS[kind] += 1
+
+def _scan_object(text: str, start: int):
+    """Percorre o objeto que começa em start.
+
+    Retorna (fim, []) se ele fecha, ou (None, candidatos) se a resposta foi
+    truncada no meio dele.
+    """
+    stack, in_string, escape = [], False, False
+    safe_cut = None  # (posição, pilha) logo após o último valor completo
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, []
+            safe_cut = (i + 1, list(stack))
+        elif ch == ",":
+            safe_cut = (i, list(stack))
+
+    # Resposta truncada: só fecha colchetes se o último valor estiver completo.
+    # Texto ou número cortado no meio ("Coma mo", "12" de "125") é descartado.
+    candidates = []
+    tail = text[start:].rstrip().rstrip(",")
+    if not in_string and tail.endswith(('"', "}", "]")):
+        candidates.append(tail + "".join(reversed(stack)))
+    if safe_cut:
+        pos, cut_stack = safe_cut
+        candidates.append(text[start:pos] + "".join(reversed(cut_stack)))
+    return None, candidates
+
+def _close_truncated_json(text: str) -> List[str]:
+    """Isola o objeto JSON e gera candidatos fechando JSON truncado"""
+    # Objetos completos em qualquer posição, ignorando chaves soltas no texto ("{nota}")
+    decoder = json.JSONDecoder()
+    candidates = []
+    start = text.find("{")
+    while start != -1:
+        end = start + 1
+        try:
+            data, decoded_end = decoder.raw_decode(text, start)
+            if isinstance(data, dict):
+                candidates.append(text[start:decoded_end])
+                end = decoded_end
+        except ValueError:
+            pass
+        start = text.find("{", end)
+
+    # Depois o primeiro objeto que ficou aberto até o fim do texto
+    start = text.find("{")
+    while start != -1:
+        end, truncated = _scan_object(text, start)
+        if end is None:
+            return candidates + truncated
+        start = text.find("{", end)
+    return candidates
+
+def _to_number(value: Any) -> Any:
+    """Converte números vindos como texto ("12,5 g", "1.234,5 kcal") em float.
+
+    Só aceita número com unidade opcional; casos ambíguos ("1,200", "1.200"),
+    com texto extra ("12-15 g", "1.5k", "1e3") ou não finitos ("NaN", "inf")
+    viram None para a validação falhar.
+    """
+    if isinstance(value, float) and not math.isfinite(value):
+        return None  # json.loads aceita NaN/Infinity
+    if not isinstance(value, str):
+        return value
+    match = re.fullmatch(r"\s*(-?\d[\d.,]*)\s*(g|mg|kcal|%)?\s*", value, re.I)
+    if not match or match.group(1)[-1] in ".,":
+        return None
+    number = match.group(1)
+    separators = [ch for ch in number if ch in ".,"]
+    if len(set(separators)) == 2:
+        # Ambos presentes: o último é o decimal, o outro separa milhares
+        decimal = separators[-1]
+        thousands = "," if decimal == "." else "."
+        integer = number.rsplit(decimal, 1)[0]
+        if number.count(decimal) > 1 or not re.fullmatch(rf"-?\d{{1,3}}(\{thousands}\d{{3}})+", integer):
+            return None
+        number = number.replace(thousands, "").replace(decimal, ".")
+    elif len(separators) > 1:
+        # Mesmo separador repetido: só pode ser de milhares ("1.234.567")
+        if not re.fullmatch(r"-?\d{1,3}([.,]\d{3})+", number):
+            return None
+        number = number.replace(separators[0], "")
+    elif separators:
+        integer, fraction = re.split(r"[.,]", number)
+        if len(fraction) == 3 and integer.lstrip("-") != "0":
+            return None  # "1,200" pode ser 1.2 ou 1200
+        number = f"{integer}.{fraction}"
+    result = float(number)
+    return result if math.isfinite(result) else None
+
+def _normalize_analysis(data: Dict[str, Any], portion: float) -> Dict[str, Any]:
+    """Corrige desvios comuns de formato antes da validação Pydantic"""
+    nutrients = []
+    for item in data.get("nutrients") or []:
+        if not isinstance(item, dict):
+            continue
+        item = dict(item)
+        # Porção ausente é calculada; porção ambígua continua inválida
+        missing_portion = item.get("portion") is None
+        item["per100g"] = _to_number(item.get("per100g"))
+        item["portion"] = _to_number(item.get("portion"))
+        per100g = item["per100g"]
+        if missing_portion and isinstance(per100g, (int, float)) and not isinstance(per100g, bool):
+            item["portion"] = round(item["per100g"] * portion / 100, 1)
+        nutrients.append(item)
+    data["nutrients"] = nutrients
+
+    if isinstance(data.get("insights"), str):
+        data["insights"] = [data["insights"]]
+    # Aviso ausente ou descartado pelo reparo de truncamento: usa o padrão
+    if not isinstance(data.get("disclaimer"), str) or not data["disclaimer"].strip():
+        data["disclaimer"] = DEFAULT_DISCLAIMER
+    return data
+
+def _repair_analysis(content: str, portion: float) -> AnalyzeFoodOutput:
+    """Tenta reparar localmente a resposta do modelo; lança ValueError se impossível"""
+    last_error = None
+    for candidate in _close_truncated_json(content or ""):
+        try:
+            data = json.loads(candidate)
+            if isinstance(data, dict):
+                return AnalyzeFoodOutput(**_normalize_analysis(data, portion))
+        except Exception as e:
+            last_error = e
+    raise ValueError(f"JSON irreparável: {last_error}")
+
+async def parse_analysis(content: str, messages: List[Dict[str, str]], model: str,
+                         temperature: float, portion: float,
+                         priority: str, key: str, is_disconnected=None) -> AnalyzeFoodOutput:
+    """Valida a resposta do modelo, reparando localmente antes de pedir de novo.
+
+    Só faz uma única nova chamada (com o erro e a resposta anterior) quando o
+    reparo local não é possível.
+    """
+    try:
+        result = AnalyzeFoodOutput(**json.loads(content))
+        _count_repair("ok")
+        return result
+    except Exception as e:
+        print(f"\n⚠️ RESPOSTA INVÁLIDA ({e}) - tentando reparo local...")
+
+    try:
+        result = _repair_analysis(content, portion)
+        _count_repair("repaired")
+        print("🔧 JSON reparado localmente")
+        return result
+    except ValueError as e:
+        error = e
+
+    print(f"🔁 Reparo impossível ({error}) - pedindo correção ao modelo...")
+    _count_repair("rerequested")
+    try:
+        resp = await chat_completion(
+            priority, key, is_disconnected,
+            model=model,
+            temperature=temperature,
+            messages=messages + [
+                {"role": "assistant", "content": content or ""},
+                {"role": "user", "content": (
+                    f"Sua resposta anterior é inválida ({error}). "
+                    "Retorne apenas o JSON completo e corrigido, sem texto fora dele."
+                )}
+            ],
+            response_format={"type": "json_object"}
+        )
+    except SchedulerBusy:
+        _count_repair("failed")
+        raise
+    except Exception as e:
+        _count_repair("failed")
+        raise ValueError(f"Falha ao pedir correção ao modelo: {e}") from e
+    try:
+        return _repair_analysis(resp.choices[0].message.content, portion)
+    except ValueError:
+        _count_repair("failed")
+        raise
+
 @app.post("/analyze", response_model=AnalyzeFoodOutput)
 @limiter.limit("10/minute")  # 10 requests por minuto por IP
-def analyze(request: Request, payload: AnalyzeFoodInput):
+async def analyze(request: Request, payload: AnalyzeFoodInput):
     print(f"\n🍎 RECEBIDO: {payload.food_description}")
     
     portion = payload.portion_grams if (payload.portion_grams or 0) > 0 else 100.0
@@ -119,15 +543,23 @@ def analyze(request: Request, payload: AnalyzeFoodInput):
     print(user_prompt)
     print(f"\n🤖 ENVIANDO PARA OpenAI...")
 
-    resp = client.chat.completions.create(
-        model="gpt-5-nano-2025-08-07",
-        temperature=1,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt}
-        ],
-        response_format={"type": "json_object"}
-    )
+    model, temperature = "gpt-5-nano-2025-08-07", 1
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+    key = client_key(request)
+    try:
+        resp = await chat_completion(
+            PRIORITY_INTERACTIVE, key, request.is_disconnected,
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
+    except SchedulerBusy as e:
+        print(f"\n⏳ FILA: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
     
     print(f"\n📊 TOKENS USADOS:")
     print(f"  - Input: {resp.usage.prompt_tokens}")
@@ -145,15 +577,16 @@ def analyze(request: Request, payload: AnalyzeFoodInput):
     print(content)
     
     try:
-        parsed_response = json.loads(content)
+        result = await parse_analysis(content, messages, model, temperature, portion,
+                                      PRIORITY_INTERACTIVE, key, request.is_disconnected)
         print(f"\n✅ JSON VÁLIDO - Processando...")
-        return AnalyzeFoodOutput(**parsed_response)
-    except json.JSONDecodeError as e:
-        print(f"\n❌ ERRO JSON: {e}")
-        raise
-    except Exception as e:
+        return result
+    except SchedulerBusy as e:
+        print(f"\n⏳ FILA: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
         print(f"\n❌ ERRO DE VALIDAÇÃO: {e}")
-        raise
+        raise HTTPException(status_code=502, detail="Resposta inválida do modelo")
 
 # Endpoint para Apps SDK - Tool MCP
 @app.post("/tools/analyze_food")
@@ -174,22 +607,24 @@ async def analyze_food_tool(request: Request):
     )
     
     # Chama a função de análise existente
-    result = analyze(payload)
+    result = await analyze(request, payload)
     return result.dict()
 
 # Endpoint de saúde
 @app.get("/health")
-def health_check():
+async def health_check():
     return {
         "status": "healthy",
         "timestamp": time.time(),
         "rate_limits": "5/min para tools, 10/min para análises",
-        "auth": "API key opcional" if API_KEYS else "público"
+        "auth": "API key opcional" if API_KEYS else "público",
+        "llm_output_repair": dict(REPAIR_STATS),
+        "upstream_scheduler": scheduler.stats()
     }
 
 # Endpoint MCP protocolo JSON-RPC (esperado pelo ChatGPT Apps SDK)
 @app.post("/mcp")
-async def mcp_endpoint(request: MCPRequest):
+async def mcp_endpoint(request: MCPRequest, http_request: Request):
     """Endpoint MCP compatível com ChatGPT Apps SDK usando protocolo JSON-RPC 2.0"""
     print(f"\n🔌 MCP REQUEST: {request.method} (id: {request.id})")
     
@@ -366,7 +801,6 @@ async def mcp_endpoint(request: MCPRequest):
                 # Extrai porção do mapeamento se disponível
                 if food_id in food_map:
                     desc = food_map[food_id]
-                    import re
                     weight_match = re.search(r'(\d+)g', desc)
                     if weight_match:
                         portion_grams = float(weight_match.group(1))
@@ -381,19 +815,25 @@ async def mcp_endpoint(request: MCPRequest):
                     "Gere os campos solicitados, mantendo números simples."
                 )
                 
-                resp = client.chat.completions.create(
+                messages = [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ]
+                # Montagem de documentos é trabalho em lote: prioridade background
+                key = client_key(http_request)
+                resp = await chat_completion(
+                    PRIORITY_BACKGROUND, key, http_request.is_disconnected,
                     model="gpt-4o-mini",
                     temperature=0.2,
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        {"role": "user", "content": user_prompt}
-                    ],
+                    messages=messages,
                     response_format={"type": "json_object"}
                 )
                 
                 content = resp.choices[0].message.content
-                parsed_response = json.loads(content)
-                result = AnalyzeFoodOutput(**parsed_response)
+                result = await parse_analysis(
+                    content, messages, "gpt-4o-mini", 0.2, portion_grams,
+                    PRIORITY_BACKGROUND, key, http_request.is_disconnected
+                )
                 
                 # Formata como documento completo
                 document = {
@@ -466,20 +906,25 @@ IMPORTANTE:
                 )
                 
                 print(f"🤖 ENVIANDO PARA OpenAI via MCP...")
-                resp = client.chat.completions.create(
+                messages = [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ]
+                key = client_key(http_request)
+                resp = await chat_completion(
+                    PRIORITY_INTERACTIVE, key, http_request.is_disconnected,
                     model="gpt-4o-mini",
                     temperature=0.2,
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        {"role": "user", "content": user_prompt}
-                    ],
+                    messages=messages,
                     response_format={"type": "json_object"}
                 )
                 
                 print(f"📊 TOKENS (MCP): {resp.usage.total_tokens}")
                 content = resp.choices[0].message.content
-                parsed_response = json.loads(content)
-                result = AnalyzeFoodOutput(**parsed_response)
+                result = await parse_analysis(
+                    content, messages, "gpt-4o-mini", 0.2, portion,
+                    PRIORITY_INTERACTIVE, key, http_request.is_disconnected
+                )
                 
                 # Formata resposta para o ChatGPT
                 formatted_response = f"""